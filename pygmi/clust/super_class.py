@@ -37,11 +37,12 @@ from matplotlib.patches import Polygon as mPolygon
 from matplotlib.lines import Line2D
 from matplotlib.backends.backend_qt5agg import FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT
+from numba import jit
 import geopandas as gpd
 from shapely.geometry import Polygon
-from PIL import Image, ImageDraw
+from shapely import contains_xy
 from sklearn.neighbors import KNeighborsClassifier
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import StratifiedShuffleSplit
 import sklearn.metrics as skm
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.tree import DecisionTreeClassifier
@@ -51,6 +52,11 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
                                              '..//..')))
 from pygmi.raster.datatypes import Data
 
+CHUNKSIZE = 100000  # Number of pixels classified at a time
+MAXTRAIN = 50000  # Maximum number of training pixels per class
+JIT_VERTS = 32  # Segments above which the jitted distance routine is used
+JIT_PIXELS = 1e6  # Bounding box area above which polygons are scanline filled
+
 
 class GraphMap(FigureCanvas):
     """
@@ -75,6 +81,64 @@ class GraphMap(FigureCanvas):
         self.mindx = [0, 0]
         self.csp = None
         self.subplot = None
+        self._clim_cache = {}
+        self._img_background = None
+
+        self.mpl_connect('draw_event', self.draw_callback)
+        self.mpl_connect('resize_event', self.resize_callback)
+
+    def draw_callback(self, event=None):
+        """
+        Draw callback.
+
+        The image is animated, so a full draw leaves it out. The background
+        is stored without it, so that image updates can be blitted, and the
+        image and frame are then drawn on top. The whole figure is stored,
+        since the frame extends past the axes bounding box.
+
+        Parameters
+        ----------
+        event : TYPE, optional
+            DESCRIPTION. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self.subplot is None or self.csp is None:
+            return
+        self._img_background = self.copy_from_bbox(self.figure.bbox)
+        self._draw_image()
+
+    def _draw_image(self):
+        """
+        Draw the image and the axes frame over it.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.subplot.draw_artist(self.csp)
+        for spine in self.subplot.spines.values():
+            self.subplot.draw_artist(spine)
+
+    def resize_callback(self, event=None):
+        """
+        Resize callback, which invalidates the stored background.
+
+        Parameters
+        ----------
+        event : TYPE, optional
+            DESCRIPTION. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._img_background = None
 
     def init_graph(self):
         """
@@ -88,12 +152,15 @@ class GraphMap(FigureCanvas):
         mtmp = self.mindx
         dat = self.data[mtmp[0]]
 
+        self._clim_cache = {}
+        self._img_background = None
+
         self.figure.clf()
         self.subplot = self.figure.add_subplot(111)
         self.subplot.get_xaxis().set_visible(False)
         self.subplot.get_yaxis().set_visible(False)
 
-        self.csp = self.subplot.imshow(dat.data, cmap=cm.jet)
+        self.csp = self.subplot.imshow(dat.data, cmap=cm.jet, animated=True)
 
         self.figure.canvas.draw()
 
@@ -107,18 +174,15 @@ class GraphMap(FigureCanvas):
 
         """
         mtmp = self.mindx
+
         dat = self.data[mtmp[0]].data
+        rows, cols = dat.shape
+
+        pntxy = np.empty((rows*cols, 2))
+        pntxy[:, 0] = np.tile(np.arange(cols), rows)
+        pntxy[:, 1] = np.repeat(np.arange(rows), cols)
+        pntxy[np.ma.getmaskarray(dat).ravel()] = np.nan
 
-        xtmp = np.arange(dat.shape[1])
-        ytmp = np.arange(dat.shape[0])
-        xmesh, ymesh = np.meshgrid(xtmp, ytmp)
-        xmesh = np.ma.array(xmesh, dtype=float, mask=dat.mask)
-        ymesh = np.ma.array(ymesh, dtype=float, mask=dat.mask)
-        xmesh = xmesh.flatten()
-        ymesh = ymesh.flatten()
-        xmesh = xmesh.filled(np.nan)
-        ymesh = ymesh.filled(np.nan)
-        pntxy = np.transpose([xmesh, ymesh])
         self.polyi = PolygonInteractor(self.subplot, pntxy)
 
     def update_graph(self):
@@ -134,16 +198,33 @@ class GraphMap(FigureCanvas):
         dat = self.data[mtmp[0]]
 
         if mtmp[1] > 0:
+            key = ('cdata', mtmp[1])
             cdat = self.cdata[mtmp[1] - 1].data
-            self.csp.set_data(cdat)
-            self.csp.set_clim(cdat.min(), cdat.max())
         else:
-            self.csp.set_data(dat.data)
-            self.csp.set_clim(dat.data.min(), dat.data.max())
+            key = ('data', mtmp[0])
+            cdat = dat.data
+
+        # The colour limits are only calculated once per band.
+        if key not in self._clim_cache:
+            self._clim_cache[key] = (cdat.min(), cdat.max())
+
+        self.csp.set_data(cdat)
+        self.csp.set_clim(*self._clim_cache[key])
 
         self.csp.changed()
-        self.figure.canvas.draw()
-#        self.polyi.draw_callback()
+
+        if self._img_background is None:
+            self.figure.canvas.draw_idle()
+            return
+
+        # Only the image data changed, so redraw the image, frame and
+        # polygon over the stored background rather than the whole canvas.
+        canvas = self.figure.canvas
+        canvas.restore_region(self._img_background)
+        self._draw_image()
+        if self.polyi is not None:
+            self.polyi.draw_callback()
+        canvas.blit(self.figure.bbox)
 
 
 class PolygonInteractor(QtCore.QObject):
@@ -172,7 +253,14 @@ class PolygonInteractor(QtCore.QObject):
 
         self.poly.add_callback(self.poly_changed)
         self._ind = None  # the active vert
-
+        self._xyt_cache = None  # vertices in display coords
+        self._dirty = True
+        self._redraw_pending = False
+        self._last_xy = (None, None)  # last mouse position while dragging
+
+        self.ax.callbacks.connect('xlim_changed', self.invalidate_cache)
+        self.ax.callbacks.connect('ylim_changed', self.invalidate_cache)
+        self.canvas.mpl_connect('resize_event', self.invalidate_cache)
         self.canvas.mpl_connect('draw_event', self.draw_callback)
         self.canvas.mpl_connect('button_press_event',
                                 self.button_press_callback)
@@ -203,6 +291,22 @@ class PolygonInteractor(QtCore.QObject):
         self.ax.draw_artist(self.poly)
         self.ax.draw_artist(self.line)
 
+    def invalidate_cache(self, event=None):
+        """
+        Invalidate the cached display coordinates of the vertices.
+
+        Parameters
+        ----------
+        event : TYPE, optional
+            DESCRIPTION. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._dirty = True
+
     def new_poly(self, npoly=None):
         """
         New polygon.
@@ -221,6 +325,7 @@ class PolygonInteractor(QtCore.QObject):
             npoly = [[1, 1]]
         self.poly.set_xy(npoly)
         self.line.set_data(zip(*self.poly.xy))
+        self._dirty = True
 
         self.update_plots()
         self.canvas.draw()
@@ -260,15 +365,20 @@ class PolygonInteractor(QtCore.QObject):
             Index of vertex under point.
 
         """
-        # display coords
-        xytmp = np.asarray(self.poly.xy)
-        xyt = self.poly.get_transform().transform(xytmp)
-        xtt, ytt = xyt[:, 0], xyt[:, 1]
-        dtt = np.sqrt((xtt - event.x) ** 2 + (ytt - event.y) ** 2)
-        indseq = np.nonzero(np.equal(dtt, np.amin(dtt)))[0]
-        ind = indseq[0]
-
-        if dtt[ind] >= self.epsilon:
+        if event.x is None or event.y is None:
+            return None
+
+        # display coords, only recalculated when the vertices or view change
+        if self._dirty:
+            xytmp = np.asarray(self.poly.xy)
+            self._xyt_cache = self.poly.get_transform().transform(xytmp)
+            self._dirty = False
+
+        xtt, ytt = self._xyt_cache[:, 0], self._xyt_cache[:, 1]
+        dtt = (xtt - event.x) ** 2 + (ytt - event.y) ** 2
+        ind = int(np.argmin(dtt))
+
+        if dtt[ind] >= self.epsilon ** 2:
             ind = None
 
         return ind
@@ -297,45 +407,30 @@ class PolygonInteractor(QtCore.QObject):
         self._ind = self.get_ind_under_point(event)
 
         if self._ind is None:
-            xys = self.poly.get_transform().transform(self.poly.xy)
-            ptmp = self.poly.get_transform().transform([event.xdata,
-                                                        event.ydata])
-#            ptmp = event.x, event.y  # display coords
+            xys = self._xyt_cache
 
             if len(xys) == 1:
                 self.poly.xy = np.array(
                     [(event.xdata, event.ydata)] +
                     [(event.xdata, event.ydata)])
                 self.line.set_data(zip(*self.poly.xy))
+                self._dirty = True
 
-                self.ax.draw_artist(self.poly)
-                self.ax.draw_artist(self.line)
-                self.canvas.update()
+                self._schedule_blit()
                 return
-            dmin = -1
-            imin = -1
-            for i in range(len(xys) - 1):
-                s0tmp = xys[i]
-                s1tmp = xys[i + 1]
-                dtmp = dist_point_to_segment(ptmp, s0tmp, s1tmp)
-
-                if dmin == -1:
-                    dmin = dtmp
-                    imin = i
-                elif dtmp < dmin:
-                    dmin = dtmp
-                    imin = i
-            i = imin
+
+            ptmp = self.poly.get_transform().transform([event.xdata,
+                                                        event.ydata])
+            dtmp = dist_points_to_segments(ptmp, xys[:-1], xys[1:])
+            i = int(np.argmin(dtmp))
 
             self.poly.xy = np.array(list(self.poly.xy[:i + 1]) +
                                     [(event.xdata, event.ydata)] +
                                     list(self.poly.xy[i + 1:]))
             self.line.set_data(list(zip(*self.poly.xy)))
+            self._dirty = True
 
-            self.canvas.restore_region(self.background)
-            self.ax.draw_artist(self.poly)
-            self.ax.draw_artist(self.line)
-            self.canvas.blit(self.ax.bbox)
+            self._schedule_blit()
 
     def button_release_callback(self, event):
         """
@@ -356,6 +451,7 @@ class PolygonInteractor(QtCore.QObject):
         if self.isactive is False:
             return
         self._ind = None
+        self._last_xy = (None, None)
         self.update_plots()
 
     def update_plots(self):
@@ -391,6 +487,12 @@ class PolygonInteractor(QtCore.QObject):
             return
         if event.button != 1:
             return
+        # Sub-pixel mouse events do not change anything on screen.
+        xyint = (int(event.x), int(event.y))
+        if xyint == self._last_xy:
+            return
+        self._last_xy = xyint
+
         xtmp, ytmp = event.xdata, event.ydata
 
         self.poly.xy[self._ind] = xtmp, ytmp
@@ -398,11 +500,43 @@ class PolygonInteractor(QtCore.QObject):
             self.poly.xy[-1] = xtmp, ytmp
 
         self.line.set_data(list(zip(*self.poly.xy)))
+        self._dirty = True
+
+        self._schedule_blit()
 
-        self.canvas.restore_region(self.background)
+    def _schedule_blit(self):
+        """
+        Schedule a blit of the polygon on the next event loop iteration.
+
+        Mouse events can arrive much faster than the display refreshes, so
+        repeated requests before the blit happens are coalesced into one.
+
+        Returns
+        -------
+        None.
+
+        """
+        if self._redraw_pending:
+            return
+        self._redraw_pending = True
+        QtCore.QTimer.singleShot(0, self._do_blit)
+
+    def _do_blit(self):
+        """
+        Blit the polygon and its vertices onto the canvas.
+
+        Returns
+        -------
+        None.
+
+        """
+        self._redraw_pending = False
+
+        canvas = self.poly.figure.canvas
+        canvas.restore_region(self.background)
         self.ax.draw_artist(self.poly)
         self.ax.draw_artist(self.line)
-        self.canvas.blit(self.ax.bbox)
+        canvas.blit(self.ax.bbox)
 
 
 class SuperClass(QtWidgets.QDialog):
@@ -426,7 +560,9 @@ class SuperClass(QtWidgets.QDialog):
         self.m1 = 0
         self.c = [0, 1, 0]
         self.m = [0, 0]
-        self.df = None
+        self._classes = []  # class name of each polygon
+        self._geoms = []  # polygon geometries
+        self._cache = None  # fitted classifier and its test data
 
         self.map = GraphMap(self)
         self.dpoly = QtWidgets.QPushButton('Delete Polygon')
@@ -435,10 +571,12 @@ class SuperClass(QtWidgets.QDialog):
         self.combo_class = QtWidgets.QComboBox()
         self.tablewidget = QtWidgets.QTableWidget()
         self.KNalgorithm = QtWidgets.QComboBox()
+        self.KNleafsize = QtWidgets.QComboBox()
         self.SVCkernel = QtWidgets.QComboBox()
         self.DTcriterion = QtWidgets.QComboBox()
         self.RFcriterion = QtWidgets.QComboBox()
         self.label1 = QtWidgets.QLabel()
+        self.label2 = QtWidgets.QLabel('Leaf Size:')
 
         self.mpl_toolbar = NavigationToolbar2QT(self.map, self.parent)
 
@@ -491,6 +629,8 @@ class SuperClass(QtWidgets.QDialog):
         self.label1.setText('Algorithm:')
 
         self.KNalgorithm.addItems(['auto', 'ball_tree', 'kd_tree', 'brute'])
+        self.KNleafsize.addItems(['32', '64', '128'])
+        self.KNleafsize.setCurrentText('64')
         self.DTcriterion.addItems(['gini', 'entropy'])
         self.RFcriterion.addItems(['gini', 'entropy'])
         self.SVCkernel.addItems(['rbf', 'linear', 'poly'])
@@ -513,6 +653,8 @@ class SuperClass(QtWidgets.QDialog):
         grid_class.addWidget(self.combo_class, 0, 1, 1, 1)
         grid_class.addWidget(self.label1, 1, 0, 1, 1)
         grid_class.addWidget(self.KNalgorithm, 1, 1, 1, 1)
+        grid_class.addWidget(self.label2, 2, 0, 1, 1)
+        grid_class.addWidget(self.KNleafsize, 2, 1, 1, 1)
         grid_class.addWidget(self.DTcriterion, 1, 1, 1, 1)
         grid_class.addWidget(self.RFcriterion, 1, 1, 1, 1)
         grid_class.addWidget(self.SVCkernel, 1, 1, 1, 1)
@@ -546,14 +688,19 @@ class SuperClass(QtWidgets.QDialog):
 
         """
         ctext = self.combo_class.currentText()
+        self._cache = None
 
         self.SVCkernel.setHidden(True)
         self.DTcriterion.setHidden(True)
         self.RFcriterion.setHidden(True)
         self.KNalgorithm.setHidden(True)
+        self.KNleafsize.setHidden(True)
+        self.label2.setHidden(True)
 
         if ctext == 'K Neighbors Classifier':
             self.KNalgorithm.setHidden(False)
+            self.KNleafsize.setHidden(False)
+            self.label2.setHidden(False)
             self.label1.setText('Algorithm:')
         elif ctext == 'Decision Tree Classifier':
             self.DTcriterion.setHidden(False)
@@ -574,7 +721,7 @@ class SuperClass(QtWidgets.QDialog):
         None.
 
         """
-        if self.df is None:
+        if not self._geoms:
             return
 
         classifier, _, _, X_test, y_test = self.init_classifier()
@@ -612,15 +759,14 @@ class SuperClass(QtWidgets.QDialog):
         if row == -1:
             return
 
-        self.df.loc[row] = None
-        self.df.loc[row, 'class'] = self.tablewidget.item(row, 0).text()
-#        self.df.loc[row, 'kappa'] = self.tablewidget.item(row, 1).text()
+        self._cache = None
+        self._classes[row] = self.tablewidget.item(row, 0).text()
 
         xycoords = self.map.polyi.poly.xy
         if xycoords.size < 8:
-            self.df.loc[row, 'geometry'] = Polygon([])
+            self._geoms[row] = Polygon([])
         else:
-            self.df.loc[row, 'geometry'] = Polygon(xycoords)
+            self._geoms[row] = Polygon(xycoords)
 
     def onrowchange(self, current, previous):
         """
@@ -644,9 +790,9 @@ class SuperClass(QtWidgets.QDialog):
             return
         row = current.row()
 
-        if self.df.loc[row, 'geometry'] == Polygon([]):
+        if self._geoms[row].is_empty:
             return
-        coords = list(self.df.loc[row, 'geometry'].exterior.coords)
+        coords = list(self._geoms[row].exterior.coords)
         self.map.polyi.new_poly(coords)
 
     def ontablechange(self, row, column):
@@ -676,10 +822,6 @@ class SuperClass(QtWidgets.QDialog):
         None.
 
         """
-        if self.df is None:
-            self.df = gpd.GeoDataFrame(columns=['class', 'geometry'])
-            self.df.set_geometry('geometry')
-
         row = self.tablewidget.rowCount()
         self.tablewidget.insertRow(row)
         item = QtWidgets.QTableWidgetItem('Class '+str(row+1))
@@ -691,13 +833,12 @@ class SuperClass(QtWidgets.QDialog):
 
         self.map.polyi.new_poly([[1, 1]])
 
-        self.df.loc[row] = None
-        self.df.loc[row, 'class'] = self.tablewidget.item(row, 0).text()
-#        self.df.loc[row, 'kappa'] = self.tablewidget.item(row, 1).text()
-        self.df.loc[row, 'geometry'] = Polygon([])
+        self._classes.append(self.tablewidget.item(row, 0).text())
+        self._geoms.append(Polygon([]))
 
         self.tablewidget.selectRow(row)
         self.map.polyi.isactive = True
+        self._cache = None
 
     def on_dpoly(self):
         """
@@ -709,9 +850,12 @@ class SuperClass(QtWidgets.QDialog):
 
         """
         row = self.tablewidget.currentRow()
-        self.tablewidget.removeRow(self.tablewidget.currentRow())
-        self.df = self.df.drop(row)
-        self.df = self.df.reset_index(drop=True)
+        if row == -1:
+            return
+        self.tablewidget.removeRow(row)
+        del self._classes[row]
+        del self._geoms[row]
+        self._cache = None
         if self.tablewidget.rowCount() == 0:
             self.map.polyi.new_poly()
             self.map.polyi.isactive = False
@@ -725,7 +869,11 @@ class SuperClass(QtWidgets.QDialog):
         None.
 
         """
-        self.m[0] = self.combo.currentIndex()
+        idx = self.combo.currentIndex()
+        if idx == self.m[0]:
+            return
+
+        self.m[0] = idx
         self.map.update_graph()
 
     def load_shape(self):
@@ -750,16 +898,18 @@ class SuperClass(QtWidgets.QDialog):
         if 'class' not in df or 'geometry' not in df:
             return False
 
-        self.df = df
+        self._classes = list(df['class'])
+        self._geoms = list(df['geometry'])
+        self._cache = None
         self.tablewidget.setRowCount(0)
-        for index, _ in self.df.iterrows():
+        for index in range(len(self._geoms)):
             self.tablewidget.insertRow(index)
             item = QtWidgets.QTableWidgetItem('Class '+str(index+1))
             self.tablewidget.setItem(index, 0, item)
 
         self.map.polyi.isactive = True
         self.tablewidget.selectRow(0)
-        coords = list(self.df.loc[0, 'geometry'].exterior.coords)
+        coords = list(self._geoms[0].exterior.coords)
         self.map.polyi.new_poly(coords)
 
     def save_shape(self):
@@ -778,7 +928,8 @@ class SuperClass(QtWidgets.QDialog):
         if filename == '':
             return False
 
-        self.df.to_file(filename)
+        df = gpd.GeoDataFrame({'class': self._classes}, geometry=self._geoms)
+        df.to_file(filename)
 
     def settings(self):
         """
@@ -796,6 +947,7 @@ class SuperClass(QtWidgets.QDialog):
             return False
 
         self.map.data = self.indata['Raster']
+        self._cache = None
 
         bands = [i.dataid for i in self.indata['Raster']]
 
@@ -819,10 +971,20 @@ class SuperClass(QtWidgets.QDialog):
         rows, cols, bands = datall.shape
 
         datall.shape = (rows*cols, bands)
-        yout = classifier.predict(datall)
-        yout.shape = (rows, cols)
 
-        datall.shape = (rows, cols, bands)
+        # Only unmasked pixels are classified, in chunks to limit memory use.
+        # Masked pixels get a label of -1, so they are skipped in the
+        # statistics below.
+        valid = ~np.ma.getmaskarray(self.map.data[0].data).ravel()
+        yout = np.full(rows*cols, -1, dtype=np.int32)
+        for i in range(0, rows*cols, CHUNKSIZE):
+            vtmp = valid[i:i+CHUNKSIZE]
+            if not vtmp.any():
+                continue
+            xtmp = np.ascontiguousarray(datall[i:i+CHUNKSIZE][vtmp],
+                                        dtype=np.float32)
+            ytmp = yout[i:i+CHUNKSIZE]
+            ytmp[vtmp] = classifier.predict(xtmp)
 
         data = copy.copy(self.indata['Raster'])
         dat_out = [Data()]
@@ -831,7 +993,8 @@ class SuperClass(QtWidgets.QDialog):
         for k in data:
             dat_out[-1].metadata['Cluster']['input_type'].append(k.dataid)
 
-        zonal = np.ma.array(yout, mask=self.map.data[0].data.mask)
+        zonal = np.ma.array(yout.reshape(rows, cols),
+                            mask=self.map.data[0].data.mask)
 
         if self.parent is None:
             plt.imshow(zonal)
@@ -847,14 +1010,26 @@ class SuperClass(QtWidgets.QDialog):
 #        if cfit.labels_.max() > 0:
 #            dat_out[-1].metadata['Cluster']['vrc'] = skm.calinski_harabasz_score(X, cfit.labels_)
 
-        m = []
-        s = []
-        for i2 in lbls:
-            m.append(datall[yout == i2].mean(0))
-            s.append(datall[yout == i2].std(0))
+        # Class statistics from per class counts, sums and sums of squares,
+        # each gathered in one pass. Masked pixels (label -1) fall in the
+        # first bin, which is discarded.
+        ytmp = yout + 1
+        nbins = lbls.max() + 2
+        cnt = np.bincount(ytmp, minlength=nbins)[lbls+1]
+        m = np.zeros([len(lbls), bands])
+        s = np.zeros([len(lbls), bands])
+        for j in range(bands):
+            dtmp = datall[:, j].astype(np.float64)
+            sums = np.bincount(ytmp, weights=dtmp, minlength=nbins)[lbls+1]
+            sqs = np.bincount(ytmp, weights=dtmp*dtmp,
+                              minlength=nbins)[lbls+1]
+            m[:, j] = sums/cnt
+            s[:, j] = np.sqrt(np.maximum(sqs/cnt - m[:, j]**2, 0.))
 
-        dat_out[-1].metadata['Cluster']['center'] = np.array(m)
-        dat_out[-1].metadata['Cluster']['center_std'] = np.array(s)
+        datall.shape = (rows, cols, bands)
+
+        dat_out[-1].metadata['Cluster']['center'] = m
+        dat_out[-1].metadata['Cluster']['center_std'] = s
 
 #        self.log = ('Cluster complete' + ' (' + self.cltype+')')
 #
@@ -897,48 +1072,82 @@ class SuperClass(QtWidgets.QDialog):
         """
         ctext = self.combo_class.currentText()
 
+        # The classifier is only retrained if the training data or
+        # hyperparameters changed, so that reported metrics correspond to
+        # the classifier actually used for classification.
+        sig = (ctext, self.KNalgorithm.currentText(),
+               self.KNleafsize.currentText(), self.DTcriterion.currentText(),
+               self.RFcriterion.currentText(), self.SVCkernel.currentText())
+        if self._cache is not None and self._cache['sig'] == sig:
+            cache = self._cache
+            return (cache['classifier'], cache['lbls'], cache['datall'],
+                    cache['X_test'], cache['y_test'])
+
         if ctext == 'K Neighbors Classifier':
             alg = self.KNalgorithm.currentText()
-            classifier = KNeighborsClassifier(algorithm=alg)
+            leaf = int(self.KNleafsize.currentText())
+            # For 'auto', a KD tree is used for the few bands typical of
+            # rasters. Above 20 bands it degrades, so brute force is used.
+            if alg == 'auto':
+                if len(self.map.data) <= 20:
+                    alg = 'kd_tree'
+                else:
+                    alg = 'brute'
+            classifier = KNeighborsClassifier(algorithm=alg, leaf_size=leaf,
+                                              n_jobs=-1)
         elif ctext == 'Decision Tree Classifier':
             crit = self.DTcriterion.currentText()
             classifier = DecisionTreeClassifier(criterion=crit)
         elif ctext == 'Random Forest Classifier':
             crit = self.RFcriterion.currentText()
-            classifier = RandomForestClassifier(criterion=crit)
+            classifier = RandomForestClassifier(criterion=crit, n_jobs=-1)
         elif ctext == 'Support Vector Classifier':
             ker = self.SVCkernel.currentText()
             classifier = SVC(gamma='scale', kernel=ker)
 
         rows, cols = self.map.data[0].data.shape
-        masks = {}
-        for _, row in self.df.iterrows():
-            pixels = list(row['geometry'].exterior.coords)
-            cname = row['class']
-            if cname not in masks:
-                masks[cname] = np.zeros((rows, cols), dtype=bool)
-
-            rasterPoly = Image.new("L", (cols, rows), 1)
-            rasterize = ImageDraw.Draw(rasterPoly)
-            rasterize.polygon(pixels)
-            mask = np.array(rasterPoly, dtype=bool)
-
-            masks[cname] = np.logical_or(~mask, masks[cname])
-
-        datall = []
-        for i in self.map.data:
-            datall.append(i.data)
-        datall = np.array(datall)
-        datall = np.moveaxis(datall, 0, -1)
-
-        y = []
-        x = []
-        for i, lbl in enumerate(masks):
-            y += [i]*masks[lbl].sum()
-            x.append(datall[masks[lbl]])
-
-        y = np.array(y)
-        x = np.vstack(x)
+
+        # Single label raster, with 0 being unlabelled and i+1 being class i.
+        # Each polygon is only tested on the pixels within its bounding box.
+        classes = []
+        lbl_raster = np.zeros((rows, cols), dtype=np.int32)
+        for cname, geom in zip(self._classes, self._geoms):
+            if cname not in classes:
+                classes.append(cname)
+
+            if geom.is_empty:
+                continue
+
+            minx, miny, maxx, maxy = geom.bounds
+            x0 = max(int(np.ceil(minx)), 0)
+            y0 = max(int(np.ceil(miny)), 0)
+            x1 = min(int(maxx)+1, cols)
+            y1 = min(int(maxy)+1, rows)
+            if x0 >= x1 or y0 >= y1:
+                continue
+
+            lbl = classes.index(cname)+1
+            if ((x1-x0)*(y1-y0) > JIT_PIXELS and geom.geom_type == 'Polygon'
+                    and not geom.interiors):
+                vxy = np.array(geom.exterior.coords, dtype=np.float64)
+                _scanline_fill(vxy[:, 0]-x0, vxy[:, 1]-y0,
+                               lbl_raster[y0:y1, x0:x1], lbl)
+                continue
+
+            xmesh, ymesh = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1))
+            mask = contains_xy(geom, xmesh, ymesh)
+            lbl_raster[y0:y1, x0:x1][mask] = lbl
+
+        # sklearn converts to contiguous float32 internally for the tree and
+        # neighbour classifiers, so supplying it up front avoids that copy.
+        datall = np.stack([np.ascontiguousarray(i.data, dtype=np.float32)
+                           for i in self.map.data], axis=-1)
+
+        # Training pixels are tracked by index, so that the data is only
+        # copied once, into the final training and test sets.
+        lbl_raster = lbl_raster.ravel()
+        pix = np.flatnonzero(lbl_raster)
+        y = lbl_raster[pix] - 1
         lbls = np.unique(y)
 
         if len(lbls) < 2:
@@ -948,10 +1157,26 @@ class SuperClass(QtWidgets.QDialog):
         # Encoding categorical data
 #        labelencoder = LabelEncoder()
 #        y = labelencoder.fit_transform(y)
-        X_train, X_test, y_train, y_test = train_test_split(x, y, stratify=y)
-
-
-        classifier.fit(X_train, y_train)
+        sss = StratifiedShuffleSplit(n_splits=1, test_size=0.25)
+        train_idx, test_idx = next(sss.split(np.zeros(y.size), y))
+
+        # Subsample large classes for training, which keeps fitting time and
+        # memory manageable for large polygons.
+        keep = []
+        for lbl in lbls:
+            idx = train_idx[y[train_idx] == lbl]
+            if idx.size > MAXTRAIN:
+                idx = np.random.choice(idx, MAXTRAIN, replace=False)
+            keep.append(idx)
+        train_idx = np.concatenate(keep)
+
+        x = datall.reshape(-1, datall.shape[-1])
+        classifier.fit(x[pix[train_idx]], y[train_idx])
+        X_test = x[pix[test_idx]]
+        y_test = y[test_idx]
+
+        self._cache = {'sig': sig, 'classifier': classifier, 'lbls': lbls,
+                       'datall': datall, 'X_test': X_test, 'y_test': y_test}
 
         return classifier, lbls, datall, X_test, y_test
 
@@ -1007,25 +1232,137 @@ def dist_point_to_segment(p, s0, s1):
         Distance of point to segment.
 
     """
-    p = np.array(p)
-    s0 = np.array(s0)
-    s1 = np.array(s1)
+    return dist_points_to_segments(p, [s0], [s1])[0]
+
+
+def dist_points_to_segments(p, s0, s1):
+    """
+    Distance of a point to a series of segments.
+
+    Vectorised version of dist_point_to_segment. Follows
+    http://geomalgorithms.com/a02-_lines.html
+
+    Parameters
+    ----------
+    p : numpy array
+        Point.
+    s0 : numpy array
+        Starts of segments, with shape (N, 2).
+    s1 : numpy array
+        Ends of segments, with shape (N, 2).
+
+    Returns
+    -------
+    numpy array
+        Distances of point to each segment.
+
+    """
+    p = np.asarray(p, dtype=np.float64)
+    s0 = np.asarray(s0, dtype=np.float64)
+    s1 = np.asarray(s1, dtype=np.float64)
+
+    if s0.shape[0] > JIT_VERTS:
+        return _seg_dists(p[0], p[1], s0, s1)
 
     v = s1 - s0
     w = p - s0
 
-    c1 = np.dot(w, v)
-    if c1 <= 0:
-        return np.linalg.norm(p - s0)
+    c1 = (w*v).sum(-1)
+    c2 = (v*v).sum(-1)
+    b = np.clip(c1/np.where(c2 == 0, 1, c2), 0, 1)
+    pb = s0 + b[:, None]*v
+
+    return np.linalg.norm(p - pb, axis=-1)
 
-    c2 = np.dot(v, v)
-    if c2 <= c1:
-        return np.linalg.norm(p - s1)
 
-    b = c1/c2
-    pb = s0 + b*v
+@jit(nopython=True, fastmath=True)
+def _seg_dists(px, py, s0, s1):
+    """
+    Distance of a point to a series of segments, in a single pass.
 
-    return np.linalg.norm(p - pb)
+    Parameters
+    ----------
+    px : float
+        X coordinate of point.
+    py : float
+        Y coordinate of point.
+    s0 : numpy array
+        Starts of segments, with shape (N, 2).
+    s1 : numpy array
+        Ends of segments, with shape (N, 2).
+
+    Returns
+    -------
+    dist : numpy array
+        Distances of point to each segment.
+
+    """
+    dist = np.empty(s0.shape[0])
+    for i in range(s0.shape[0]):
+        vx = s1[i, 0] - s0[i, 0]
+        vy = s1[i, 1] - s0[i, 1]
+        wx = px - s0[i, 0]
+        wy = py - s0[i, 1]
+
+        c1 = wx*vx + wy*vy
+        c2 = vx*vx + vy*vy
+        if c1 <= 0:
+            b = 0.
+        elif c2 <= c1:
+            b = 1.
+        else:
+            b = c1/c2
+
+        dx = wx - b*vx
+        dy = wy - b*vy
+        dist[i] = np.sqrt(dx*dx + dy*dy)
+
+    return dist
+
+
+@jit(nopython=True)
+def _scanline_fill(vx, vy, out, val):
+    """
+    Scanline fill of a polygon.
+
+    Pixels of out with centres inside the polygon are set to val, using the
+    even-odd rule.
+
+    Parameters
+    ----------
+    vx : numpy array
+        X coordinates of the closed polygon, in pixels of out.
+    vy : numpy array
+        Y coordinates of the closed polygon, in pixels of out.
+    out : numpy array
+        Output raster.
+    val : int
+        Value to fill polygon with.
+
+    Returns
+    -------
+    None.
+
+    """
+    nrows, ncols = out.shape
+    xint = np.empty(vx.size)
+
+    for i in range(nrows):
+        # Intersections of the scanline through the pixel centres with edges
+        nint = 0
+        for k in range(vx.size-1):
+            ya = vy[k]
+            yb = vy[k+1]
+            if (ya <= i < yb) or (yb <= i < ya):
+                xint[nint] = vx[k] + (i-ya)*(vx[k+1]-vx[k])/(yb-ya)
+                nint += 1
+
+        xsort = np.sort(xint[:nint])
+        for k in range(0, nint-1, 2):
+            j0 = max(int(np.floor(xsort[k]))+1, 0)
+            j1 = min(int(np.ceil(xsort[k+1]))-1, ncols-1)
+            for j in range(j0, j1+1):
+                out[i, j] = val
 
 
 def test():
@@ -30,13 +30,32 @@
 |    http://www.wits.ac.za/science/geophysics/gc.htm
 """
 
+import os
+import importlib.util
 import copy
+import threading
+from collections import OrderedDict
+from functools import partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5 import QtWidgets, QtCore
 import numpy as np
-import scipy.signal as si
+from scipy import ndimage
+from scipy import fft as sfft
+from numba import jit, prange, vectorize, float32, float64
 
 import pygmi.menu_default as menu_default
 
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+# pyFFTW plans own their input and output arrays, so each thread keeps its
+# own plans. Only the most recent grid sizes are kept, since each plan holds
+# full size buffers.
+_plan_cache = threading.local()
+_PLAN_CACHE_SIZE = 2
+
 
 class Gradients(QtWidgets.QDialog):
     """
@@ -75,6 +94,8 @@ class Gradients(QtWidgets.QDialog):
         self.rb_dratio = QtWidgets.QRadioButton('Derivative Ratio')
         self.label_or = QtWidgets.QLabel('Strength Factor')
         self.label_az = QtWidgets.QLabel('Azimuth')
+        self.cb_fast = QtWidgets.QCheckBox('Fast approximate arctan '
+                                           '(display only)')
 
         self.setupui()
 
@@ -103,6 +124,7 @@ class Gradients(QtWidgets.QDialog):
         self.rb_ddir.setChecked(True)
         self.sb_order.hide()
         self.label_or.hide()
+        self.cb_fast.hide()
 
         self.setWindowTitle('Gradient Calculation')
 
@@ -113,8 +135,9 @@ class Gradients(QtWidgets.QDialog):
         gridlayout.addWidget(self.sb_azi, 3, 1, 1, 1)
         gridlayout.addWidget(self.label_or, 4, 0, 1, 1)
         gridlayout.addWidget(self.sb_order, 4, 1, 1, 1)
-        gridlayout.addWidget(helpdocs, 5, 0, 1, 1)
-        gridlayout.addWidget(buttonbox, 5, 1, 1, 1)
+        gridlayout.addWidget(self.cb_fast, 5, 0, 1, 2)
+        gridlayout.addWidget(helpdocs, 6, 0, 1, 1)
+        gridlayout.addWidget(buttonbox, 6, 1, 1, 1)
 
         buttonbox.accepted.connect(self.accept)
         buttonbox.rejected.connect(self.reject)
@@ -139,15 +162,31 @@ class Gradients(QtWidgets.QDialog):
         self.azi = self.sb_azi.value()
         self.order = self.sb_order.value()
 
-        data = copy.deepcopy(self.indata['Raster'])
+        data = [_copy_meta(i) for i in self.indata['Raster']]
+
+        if self.rb_ddir.isChecked():
+            # Bands with the same shape and cell size are done in one call.
+            groups = {}
+            for i, band in enumerate(data):
+                key = (band.data.shape, band.xdim, band.ydim)
+                groups.setdefault(key, []).append(i)
+
+            for (_, xdim, ydim), idx in self.pbar.iter(list(groups.items())):
+                arr = np.ma.stack([data[i].data for i in idx])
+                dt1 = gradients(arr, self.azi, xdim, ydim)
+                for i, band in zip(idx, dt1):
+                    data[i].data = band
+                    data[i].units = ''
+
+            self.outdata['Raster'] = data
+
+            return True
 
         for i in self.pbar.iter(range(len(data))):
-            if self.rb_ddir.isChecked():
-                data[i].data = gradients(data[i].data, self.azi, data[i].xdim,
-                                         data[i].ydim)
-            elif self.rb_dratio.isChecked():
+            if self.rb_dratio.isChecked():
                 data[i].data = derivative_ratio(data[i].data, self.azi,
-                                                self.order)
+                                                self.order,
+                                                self.cb_fast.isChecked())
             else:
                 if data[i].xdim != data[i].ydim:
                     print('X and Y dimension are different. Please resample')
@@ -176,10 +215,12 @@ class Gradients(QtWidgets.QDialog):
         self.label_or.hide()
         self.sb_azi.hide()
         self.label_az.hide()
+        self.cb_fast.hide()
 
         if self.rb_dratio.isChecked():
             self.sb_order.show()
             self.label_or.show()
+            self.cb_fast.show()
             self.sb_azi.show()
             self.label_az.show()
         elif self.rb_ddir.isChecked():
@@ -187,6 +228,31 @@ class Gradients(QtWidgets.QDialog):
             self.label_az.show()
 
 
+def _copy_meta(band):
+    """
+    Copy a raster band without copying its data.
+
+    All attributes except the data are deep copied. The new band shares the
+    data array of the original, and is expected to have it replaced.
+
+    Parameters
+    ----------
+    band : PyGMI Data
+        Input band.
+
+    Returns
+    -------
+    out : PyGMI Data
+        Copy of the band.
+
+    """
+    out = copy.copy(band)
+    out.__dict__ = {key: (val if key == 'data' else copy.deepcopy(val))
+                    for key, val in band.__dict__.items()}
+
+    return out
+
+
 def gradients(data, azi, xint, yint):
     """
     Gradients.
@@ -197,9 +263,14 @@ def gradients(data, azi, xint, yint):
     Parameters
     ----------
     data : numpy array
-        input numpy data array
+        input numpy data array. A 3D stack of bands is accepted, in which
+        case the derivative is taken over the last two axes.
     azi : float
         Filter direction (degrees)
+    xint : float
+        X cell size
+    yint : float
+        Y cell size
 
     Returns
     -------
@@ -207,13 +278,13 @@ def gradients(data, azi, xint, yint):
         returns directional derivative
     """
     azi = np.deg2rad(azi)
-    dy, dx = np.gradient(data, yint, xint)
+    dy, dx = _grad2d(data, yint, xint)
     dt1 = -dy*np.sin(azi)-dx*np.cos(azi)
 
     return dt1
 
 
-def derivative_ratio(data, azi, order):
+def derivative_ratio(data, azi, order, fast=False):
     """
     Compute derivative ratio of image data. Based on code by Gordon Cooper.
 
@@ -225,6 +296,9 @@ def derivative_ratio(data, azi, order):
         Filter direction (degrees)
     order : int
         Order of DR filter - see paper. Try 1 first.
+    fast : bool, optional
+        Use an approximate arctan, accurate to about 2e-6 radians. This is
+        meant for display. The default is False.
 
     Returns
     -------
@@ -234,18 +308,154 @@ def derivative_ratio(data, azi, order):
     # Directional derivative
 
     azi = np.deg2rad(azi)
-    dx, dy = np.gradient(data)
-    dt1 = -dy*np.sin(azi)-dx*np.cos(azi)
+    sina = np.sin(azi)
+    cosa = np.cos(azi)
+    dx, dy = _grad2d(data)
+    dt1 = -dy*sina-dx*cosa
 
-    # Derivative ratio
+    # Derivative ratio, using sin(a+pi/2) = cos(a) and cos(a+pi/2) = -sin(a)
 
-    dt2 = -dy*np.sin(azi+np.pi/2)-dx*np.cos(azi+np.pi/2)
+    dt2 = -dy*cosa+dx*sina
     dt2 = dt2.astype(np.float64)
-    dr = np.arctan2(dt1, abs(dt2)**order)
+    if fast:
+        dr = _fast_arctan2(dt1, abs(dt2)**order)
+    else:
+        dr = np.arctan2(dt1, abs(dt2)**order)
 
     return dr
 
 
+def _fast_arctan2(y, x):
+    """
+    Fast approximate arctan2.
+
+    The angle is reduced to [0, pi/4] and a minimax polynomial is used,
+    giving a maximum error of about 2e-6 radians. NaN inputs give NaN, as
+    with np.arctan2. The parallel ufunc is compiled on first use, so that
+    importing this module stays quick.
+
+    Parameters
+    ----------
+    y : numpy array
+        Y coordinates.
+    x : numpy array or float
+        X coordinates.
+
+    Returns
+    -------
+    theta : numpy array
+        Angles in radians.
+
+    """
+    # The vectorised loop may evaluate the comparisons for NaN elements as
+    # well, which raises the invalid flag even though the result is NaN.
+    with np.errstate(invalid='ignore'):
+        theta = _arctan2_ufunc()(y, x)
+
+    return theta
+
+
+@lru_cache(maxsize=None)
+def _arctan2_ufunc():
+    """
+    Compile the fast arctan2 ufunc.
+
+    Returns
+    -------
+    numba ufunc
+        Parallel ufunc for float32 and float64.
+
+    """
+    return vectorize([float32(float32, float32), float64(float64, float64)],
+                     target='parallel', cache=True)(_arctan2_kernel)
+
+
+def _arctan2_kernel(y, x):
+    """
+    Fast approximate arctan2 for scalars.
+
+    Parameters
+    ----------
+    y : float
+        Y coordinate.
+    x : float
+        X coordinate.
+
+    Returns
+    -------
+    theta : float
+        Angle in radians.
+
+    """
+    # NaN propagates, as with np.arctan2. This is checked first, since the
+    # ordered comparisons below raise the invalid flag for NaN.
+    if x != x or y != y:
+        return x+y
+
+    ax = abs(x)
+    ay = abs(y)
+    big = ay > ax
+    # Avoid 0/0 at the origin, where the angle is taken as zero.
+    if big:
+        z = ax/ay
+    else:
+        z = ay/(ax+(ax == 0.))
+    z2 = z*z
+    theta = z*(0.99997726+z2*(-0.33262347+z2*(0.19354346+z2*(
+        -0.11643287+z2*(0.05265332+z2*-0.01172120)))))
+
+    if big:
+        theta = np.pi/2-theta
+    if x < 0.:
+        theta = np.pi-theta
+    if y < 0.:
+        theta = -theta
+
+    return theta
+
+
+def _grad2d(data, yint=1., xint=1.):
+    """
+    Gradient over the last two axes of an array.
+
+    This gives the same result as np.gradient with first order edges, but
+    writes the central differences and edges straight into the outputs.
+    Masked arrays are supported.
+
+    Parameters
+    ----------
+    data : numpy array
+        Input data, either 2D or a stack of 2D bands.
+    yint : float, optional
+        Spacing along the second last axis. The default is 1.
+    xint : float, optional
+        Spacing along the last axis. The default is 1.
+
+    Returns
+    -------
+    dy : numpy array
+        Derivative along the second last axis.
+    dx : numpy array
+        Derivative along the last axis.
+
+    """
+    data = np.asanyarray(data)
+    if not np.issubdtype(data.dtype, np.inexact):
+        data = data.astype(np.float64)
+
+    dy = np.empty_like(data)
+    dy[..., 1:-1, :] = (data[..., 2:, :]-data[..., :-2, :])/(2.*yint)
+    dy[..., 0, :] = (data[..., 1, :]-data[..., 0, :])/yint
+    dy[..., -1, :] = (data[..., -1, :]-data[..., -2, :])/yint
+
+    dx = np.empty_like(data)
+    dx[..., 1:-1] = (data[..., 2:]-data[..., :-2])/(2.*xint)
+    dx[..., 0] = (data[..., 1]-data[..., 0])/xint
+    dx[..., -1] = (data[..., -1]-data[..., -2])/xint
+
+    return dy, dx
+
+
 class Visibility2d(QtWidgets.QDialog):
     """
     Class used to gather information via a GUI, for function visibility2d.
@@ -275,6 +485,7 @@ class Visibility2d(QtWidgets.QDialog):
 
         self.sb_dh = QtWidgets.QSpinBox()
         self.sb_wsize = QtWidgets.QSpinBox()
+        self.cb_gpu = QtWidgets.QCheckBox('Use GPU (requires CuPy)')
 
         self.setupui()
 
@@ -302,6 +513,7 @@ class Visibility2d(QtWidgets.QDialog):
         self.sb_wsize.setMinimum(3)
         self.sb_wsize.setMaximum(100000)
         self.sb_wsize.setSingleStep(2)
+        self.cb_gpu.setEnabled(importlib.util.find_spec('cupy') is not None)
         buttonbox.setOrientation(QtCore.Qt.Horizontal)
         buttonbox.setStandardButtons(buttonbox.Cancel | buttonbox.Ok)
 
@@ -311,8 +523,9 @@ class Visibility2d(QtWidgets.QDialog):
         gridlayout.addWidget(self.sb_wsize, 0, 1, 1, 1)
         gridlayout.addWidget(label, 1, 0, 1, 1)
         gridlayout.addWidget(self.sb_dh, 1, 1, 1, 1)
-        gridlayout.addWidget(helpdocs, 2, 0, 1, 1)
-        gridlayout.addWidget(buttonbox, 2, 1, 1, 1)
+        gridlayout.addWidget(self.cb_gpu, 2, 0, 1, 2)
+        gridlayout.addWidget(helpdocs, 3, 0, 1, 1)
+        gridlayout.addWidget(buttonbox, 3, 1, 1, 1)
 
         buttonbox.accepted.connect(self.accept)
         buttonbox.rejected.connect(self.reject)
@@ -334,18 +547,28 @@ class Visibility2d(QtWidgets.QDialog):
         self.wsize = self.sb_wsize.value()
         self.dh = self.sb_dh.value()
 
-        data = copy.deepcopy(self.indata['Raster'])
+        data = self.indata['Raster']
         data2 = []
 
-        for i, datai in enumerate(data):
+        for datai in data:
             print(datai.dataid+':')
 
-            vtot, vstd, vsum = visibility2d(datai.data, self.wsize,
-                                            self.dh*data[i].data.std()/100.,
-                                            self.pbar.iter)
-            data2.append(copy.deepcopy(datai))
-            data2.append(copy.deepcopy(datai))
-            data2.append(copy.deepcopy(datai))
+            dh = self.dh*datai.data.std()/100.
+            vis = None
+            if self.cb_gpu.isChecked():
+                # CuPy can be found but still fail to import, in which case
+                # the CPU version is used.
+                try:
+                    vis = visibility2d_gpu(datai.data, self.wsize, dh)
+                except ImportError:
+                    print('CuPy could not be imported, using the CPU.')
+            if vis is None:
+                vis = visibility2d(datai.data, self.wsize, dh,
+                                   self.pbar.iter)
+            vtot, vstd, vsum = vis
+            data2.append(_copy_meta(datai))
+            data2.append(_copy_meta(datai))
+            data2.append(_copy_meta(datai))
             data2[-3].data = vtot
             data2[-2].data = vstd
             data2[-1].data = vsum
@@ -386,88 +609,241 @@ def visibility2d(data, wsize, dh, piter=iter):
 
     """
     nr, nc = np.shape(data)
-    wsize = abs(np.real(wsize))
+    wsize = int(abs(np.real(wsize)))
+    w2 = int(np.floor(wsize/2))
+    dh = float(dh)
+    vtot = np.zeros([nr-2*w2, nc-2*w2])
+    vstd = np.zeros([nr-2*w2, nc-2*w2])
+    vsum = np.zeros([nr-2*w2, nc-2*w2])
+    mask = np.ma.getmaskarray(data)
+    mean = data.mean()
+    data = data.data.astype(np.float64)
+    data[mask] = mean
+
+    # The forward scans only reach the end of the window, which is short of
+    # w2 for even window sizes.
+    w1 = wsize-1-w2
+
+    # Rows are processed in blocks so that progress can be reported.
+    bsize = 64
+    for i0 in piter(range(w2, nr-w2, bsize)):
+        i1 = min(i0+bsize, nr-w2)
+        _visibility_kernel(data, w1, w2, dh, i0, i1, vtot, vstd, vsum)
+
+    # The outputs are already trimmed. Each gets its own copy of the
+    # trimmed mask, since np.ma shares masks passed in and the mask is a
+    # view of the input mask.
+    trim_mask = mask[w2:nr-w2, w2:nc-w2]
+    vtot = np.ma.array(vtot, mask=trim_mask.copy(), copy=False)
+    vstd = np.ma.array(vstd, mask=trim_mask.copy(), copy=False)
+    vsum = np.ma.array(vsum, mask=trim_mask.copy(), copy=False)
+
+    return vtot, vstd, vsum
+
+
+_VISIBILITY_CUDA = r'''
+__device__ int visible(const double* data, int nc, int i, int j, int di,
+                       int dj, int w, double dh, int num)
+{
+    // Count of points visible from (i, j) along (di, dj), up to w steps
+    // away. num is the count used when w <= 1.
+    if (w > 1) {
+        num = num + 1;
+        double zc = data[i*nc+j];
+        double thetamax = data[(i+di)*nc+j+dj]-zc-dh;
+        for (int k = 2; k <= w; k++) {
+            double theta = (data[(i+k*di)*nc+j+k*dj]-zc-dh)/k;
+            if (theta >= thetamax) {
+                num = num + 1;
+                thetamax = theta;
+            }
+        }
+    }
+    return num;
+}
+
+extern "C" __global__
+void visibility_kernel(const double* data, int nr, int nc, int w1, int w2,
+                       double dh, double* vtot, double* vstd, double* vsum)
+{
+    int j = blockDim.x*blockIdx.x+threadIdx.x+w2;
+    int i = blockDim.y*blockIdx.y+threadIdx.y+w2;
+    if (i >= nr-w2 || j >= nc-w2) return;
+
+    double c45 = cos(0.78539816339744830962);
+    double s45 = sin(0.78539816339744830962);
+
+    double vn = visible(data, nc, i, j, 1, 0, w1, dh, 1);
+    double vs = visible(data, nc, i, j, -1, 0, w2, dh, 0);
+    double ve = visible(data, nc, i, j, 0, 1, w1, dh, 1);
+    double vw = visible(data, nc, i, j, 0, -1, w2, dh, 0);
+    double vd1 = visible(data, nc, i, j, 1, 1, w1, dh, 1);
+    double vd2 = visible(data, nc, i, j, -1, -1, w2, dh, 0);
+    double vd3 = visible(data, nc, i, j, -1, 1, w1, dh, 1);
+    double vd4 = visible(data, nc, i, j, 1, -1, w2, dh, 0);
+
+    double tot = vn+vs+ve+vw+vd1+vd2+vd3+vd4;
+    double vmean = tot/8;
+    double var = ((vn-vmean)*(vn-vmean) + (vs-vmean)*(vs-vmean) +
+                  (ve-vmean)*(ve-vmean) + (vw-vmean)*(vw-vmean) +
+                  (vd1-vmean)*(vd1-vmean) + (vd2-vmean)*(vd2-vmean) +
+                  (vd3-vmean)*(vd3-vmean) + (vd4-vmean)*(vd4-vmean))/7;
+
+    double vsumx = ve-vw+vd1*c45-vd2*c45+vd3*c45-vd4*c45;
+    double vsumy = vn-vs+vd1*s45-vd2*s45-vd3*s45+vd4*s45;
+
+    int k = (i-w2)*(nc-2*w2)+j-w2;
+    vtot[k] = tot;
+    vstd[k] = sqrt(var);
+    vsum[k] = sqrt(vsumx*vsumx+vsumy*vsumy);
+}
+'''
+
+
+def visibility2d_gpu(data, wsize, dh):
+    """
+    Compute visibility as a textural measure, on the GPU.
+
+    This is the same calculation as visibility2d, run as a CUDA kernel with
+    one thread per output cell. It requires CuPy, which is only imported
+    when this is called, since it is slow to import.
+
+    Parameters
+    ----------
+    data : numpy array
+        input dataset - numpy MxN array
+    wsize : int
+        window size, must be odd
+    dh : float
+        height of observer above surface
+
+    Returns
+    -------
+    vtot : numpy array
+        Total visibility.
+    vstd : numpy array
+        Visibility variation.
+    vsum : numpy array
+        Visibility vector resultant.
+
+    """
+    import cupy
+
+    nr, nc = np.shape(data)
+    wsize = int(abs(np.real(wsize)))
     w2 = int(np.floor(wsize/2))
-    vn = np.zeros([nr, nc])
-    vs = np.zeros([nr, nc])
-    ve = np.zeros([nr, nc])
-    vw = np.zeros([nr, nc])
-    vd1 = np.zeros([nr, nc])
-    vd2 = np.zeros([nr, nc])
-    vd3 = np.zeros([nr, nc])
-    vd4 = np.zeros([nr, nc])
-    vstd = np.zeros([nr, nc])
     mask = np.ma.getmaskarray(data)
     mean = data.mean()
-    data = data.data
+    data = data.data.astype(np.float64)
     data[mask] = mean
 
-    for j in piter(range(nc)):    # Columns
-        for i in range(w2, nr-w2):
-            dtmp = data[i-w2:i+w2+1, j]
-            vn[i, j] = __visible1(dtmp, wsize, w2+1, dh)
-            vs[i, j] = __visible2(dtmp, w2+1, dh)
-
-    for j in piter(range(w2, nc-w2)):    # Rows
-        for i in range(nr):
-            dtmp = data[i, j-w2:j+w2+1]
-            ve[i, j] = __visible1(dtmp, wsize, w2+1, dh)
-            vw[i, j] = __visible2(dtmp, w2+1, dh)
-
-    for j in piter(range(w2, nc-w2)):
-        for i in range(w2, nr-w2):
-            dtmp = np.zeros(wsize)
-            for k in range(wsize):
-                dtmp[k] = data[i-w2+k, j-w2+k]
-            vd1[i, j] = __visible1(dtmp, wsize, w2+1, dh)
-            vd2[i, j] = __visible2(dtmp, w2+1, dh)
-            dtmp = np.zeros(wsize)
-            for k in range(wsize):
-                dtmp[k] = data[i+w2-k, j-w2+k]
-            vd3[i, j] = __visible1(dtmp, wsize, w2+1, dh)
-            vd4[i, j] = __visible2(dtmp, w2+1, dh)
-
-    vtot = vn+vs+ve+vw+vd1+vd2+vd3+vd4
-    vtot = vtot[w2:nr-w2, w2:nc-w2]
-
-    for j in piter(range(nc)):
-        for i in range(nr):
-            vstd[i, j] = np.std([vn[i, j], vs[i, j], ve[i, j], vw[i, j],
-                                 vd1[i, j], vd2[i, j], vd3[i, j],
-                                 vd4[i, j]], ddof=1)
-
-    vstd = vstd[w2:nr-w2, w2:nc-w2]
-
-    dtr = np.pi/180
-    c45 = np.cos(45*dtr)
-    s45 = np.sin(45*dtr)
-    vsumx = ve-vw+vd1*c45-vd2*c45+vd3*c45-vd4*c45
-    vsumy = vn-vs+vd1*s45-vd2*s45-vd3*s45+vd4*s45
-    vsum = np.sqrt(vsumx*vsumx+vsumy*vsumy)
-    vsum = vsum[w2:nr-w2, w2:nc-w2]
-
-    vtot = np.ma.array(vtot)
-    vstd = np.ma.array(vstd)
-    vsum = np.ma.array(vsum)
-    vtot.mask = mask[w2:-w2, w2:-w2]
-    vstd.mask = mask[w2:-w2, w2:-w2]
-    vsum.mask = mask[w2:-w2, w2:-w2]
+    kernel = cupy.RawKernel(_VISIBILITY_CUDA, 'visibility_kernel')
+
+    ddata = cupy.asarray(data)
+    shape = (nr-2*w2, nc-2*w2)
+    vtot = cupy.zeros(shape)
+    vstd = cupy.zeros(shape)
+    vsum = cupy.zeros(shape)
+
+    block = (32, 8)
+    grid = ((shape[1]+block[0]-1)//block[0], (shape[0]+block[1]-1)//block[1])
+    kernel(grid, block, (ddata, np.int32(nr), np.int32(nc),
+                         np.int32(wsize-1-w2), np.int32(w2), np.float64(dh),
+                         vtot, vstd, vsum))
+
+    trim_mask = mask[w2:nr-w2, w2:nc-w2]
+    vtot = np.ma.array(cupy.asnumpy(vtot), mask=trim_mask.copy(), copy=False)
+    vstd = np.ma.array(cupy.asnumpy(vstd), mask=trim_mask.copy(), copy=False)
+    vsum = np.ma.array(cupy.asnumpy(vsum), mask=trim_mask.copy(), copy=False)
 
     return vtot, vstd, vsum
 
 
-def __visible1(dat, nr, cp, dh):
+@jit(nopython=True, parallel=True, cache=True)
+def _visibility_kernel(data, w1, w2, dh, i0, i1, vtot, vstd, vsum):
+    """
+    Visibility kernel.
+
+    Computes all eight directional visibilities for rows i0 to i1 in one
+    pass, and accumulates them directly into the outputs.
+
+    Parameters
+    ----------
+    data : numpy array
+        Input dataset, with no masked values.
+    w1 : int
+        Forward reach of the window, which is w2-1 for even window sizes.
+    w2 : int
+        Half window size.
+    dh : float
+        Observer height.
+    i0 : int
+        First row to process.
+    i1 : int
+        Row after the last row to process.
+    vtot : numpy array
+        Total visibility, trimmed by w2 on each side.
+    vstd : numpy array
+        Visibility variation, trimmed by w2 on each side.
+    vsum : numpy array
+        Visibility vector resultant, trimmed by w2 on each side.
+
+    Returns
+    -------
+    None.
+
+    """
+    nc = data.shape[1]
+    c45 = np.cos(np.pi/4)
+    s45 = np.sin(np.pi/4)
+
+    for i in prange(i0, i1):
+        for j in range(w2, nc-w2):
+            vn = __visible1(data, i, j, 1, 0, w1, dh)
+            vs = __visible2(data, i, j, 1, 0, w2, dh)
+            ve = __visible1(data, i, j, 0, 1, w1, dh)
+            vw = __visible2(data, i, j, 0, 1, w2, dh)
+            vd1 = __visible1(data, i, j, 1, 1, w1, dh)
+            vd2 = __visible2(data, i, j, 1, 1, w2, dh)
+            vd3 = __visible1(data, i, j, -1, 1, w1, dh)
+            vd4 = __visible2(data, i, j, -1, 1, w2, dh)
+
+            tot = vn+vs+ve+vw+vd1+vd2+vd3+vd4
+            vmean = tot/8
+            var = ((vn-vmean)**2 + (vs-vmean)**2 + (ve-vmean)**2 +
+                   (vw-vmean)**2 + (vd1-vmean)**2 + (vd2-vmean)**2 +
+                   (vd3-vmean)**2 + (vd4-vmean)**2)/7
+
+            vsumx = ve-vw+vd1*c45-vd2*c45+vd3*c45-vd4*c45
+            vsumy = vn-vs+vd1*s45-vd2*s45-vd3*s45+vd4*s45
+
+            vtot[i-w2, j-w2] = tot
+            vstd[i-w2, j-w2] = np.sqrt(var)
+            vsum[i-w2, j-w2] = np.sqrt(vsumx*vsumx+vsumy*vsumy)
+
+
+@jit(nopython=True, cache=True)
+def __visible1(data, i, j, di, dj, w1, dh):
     """
     Visible 1.
 
+    Number of points visible from point (i, j), looking forward along the
+    direction (di, dj) through the window.
+
     Parameters
     ----------
-    dat : numpy array
-        Input vector.
-    nr : int
-        Window size. Must be odd.
-    cp : int
-        Center point.
+    data : numpy array
+        Input dataset.
+    i : int
+        Row of center point.
+    j : int
+        Column of center point.
+    di : int
+        Row step.
+    dj : int
+        Column step.
+    w1 : int
+        Forward reach of the window.
     dh : float
         Observer height.
 
@@ -479,29 +855,41 @@ def __visible1(dat, nr, cp, dh):
     """
     num = 1
 
-    if cp < nr-1 and dat.size > 0:
+    if w1 > 1:
         num = 2
-        cpn = cp-1
-        thetamax = float(dat[cpn+1]-dat[cpn]-dh)
-        for i in range(cpn+2, nr):
-            theta = ((dat[i]-dat[cpn]-dh)/float(i-cpn))
-            if theta >= thetamax:
-                num = num + 1
-                thetamax = theta
+        zc = data[i, j]
+        thetamax = data[i+di, j+dj]-zc-dh
+        for k in range(2, w1+1):
+            theta = (data[i+k*di, j+k*dj]-zc-dh)/k
+            # Branchless, so LLVM can use a select/max here.
+            num += theta >= thetamax
+            thetamax = max(thetamax, theta)
 
     return num
 
 
-def __visible2(dat, cp, dh):
+@jit(nopython=True, cache=True)
+def __visible2(data, i, j, di, dj, w2, dh):
     """
     Visible 2.
 
+    Number of points visible from point (i, j), looking backward along the
+    direction (di, dj) through the window.
+
     Parameters
     ----------
-    dat : numpy array
-        Input vector.
-    cp : int
-        Center point.
+    data : numpy array
+        Input dataset.
+    i : int
+        Row of center point.
+    j : int
+        Column of center point.
+    di : int
+        Row step.
+    dj : int
+        Column step.
+    w2 : int
+        Half window size.
     dh : float
         Observer height.
 
@@ -513,15 +901,16 @@ def __visible2(dat, cp, dh):
     """
     num = 0
 
-    if cp > 2 and dat.size > 0:
+    if w2 > 1:
         num = 1
-        cpn = cp-1
-        thetamax = (dat[cpn-1]-dat[cpn]-dh)
-        for i in range(cpn-2, -1, -1):
-            theta = ((dat[i]-dat[cpn]-dh)/(cpn-i))
-            if theta >= thetamax:
-                num = num + 1
-                thetamax = theta
+        zc = data[i, j]
+        thetamax = data[i-di, j-dj]-zc-dh
+        for k in range(2, w2+1):
+            theta = (data[i-k*di, j-k*dj]-zc-dh)/k
+            # Branchless, so LLVM can use a select/max here.
+            num += theta >= thetamax
+            thetamax = max(thetamax, theta)
+
     return num
 
 
@@ -554,6 +943,10 @@ class Tilt1(QtWidgets.QDialog):
 
         self.sb_azi = QtWidgets.QSpinBox()
         self.sb_s = QtWidgets.QSpinBox()
+        self.cb_jax = QtWidgets.QCheckBox('Use JAX (GPU if available)')
+        self.cb_fast = QtWidgets.QCheckBox('Fast single precision and '
+                                           'approximate arctan '
+                                           '(preview only, not for export)')
 
         self.setupui()
 
@@ -584,6 +977,7 @@ class Tilt1(QtWidgets.QDialog):
         self.sb_s.setMinimum(0)
         self.sb_s.setMaximum(100000)
         self.sb_s.setSingleStep(1)
+        self.cb_jax.setEnabled(importlib.util.find_spec('jax') is not None)
 
         self.setWindowTitle('Tilt Angle')
 
@@ -591,11 +985,27 @@ class Tilt1(QtWidgets.QDialog):
         gridlayout.addWidget(self.sb_s, 0, 1, 1, 1)
         gridlayout.addWidget(label, 1, 0, 1, 1)
         gridlayout.addWidget(self.sb_azi, 1, 1, 1, 1)
-        gridlayout.addWidget(helpdocs, 2, 0, 1, 1)
-        gridlayout.addWidget(buttonbox, 2, 1, 1, 1)
+        gridlayout.addWidget(self.cb_jax, 2, 0, 1, 2)
+        gridlayout.addWidget(self.cb_fast, 3, 0, 1, 2)
+        gridlayout.addWidget(helpdocs, 4, 0, 1, 1)
+        gridlayout.addWidget(buttonbox, 4, 1, 1, 1)
 
         buttonbox.accepted.connect(self.accept)
         buttonbox.rejected.connect(self.reject)
+        self.cb_jax.stateChanged.connect(self.jaxchange)
+
+    def jaxchange(self):
+        """
+        Check JAX checkbox state.
+
+        The JAX version of tilt1 does not have the fast option.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.cb_fast.setEnabled(not self.cb_jax.isChecked())
 
     def settings(self):
         """
@@ -614,26 +1024,57 @@ class Tilt1(QtWidgets.QDialog):
         self.smooth = self.sb_s.value()
         self.azi = self.sb_azi.value()
 
-        data = copy.deepcopy(self.indata['Raster'])
+        data = self.indata['Raster']
         data2 = []
 
-        for i in self.pbar.iter(range(len(data))):
-            t1, th, t2, ta, tdx = tilt1(data[i].data, self.azi, self.smooth)
-            data2.append(copy.deepcopy(data[i]))
-            data2.append(copy.deepcopy(data[i]))
-            data2.append(copy.deepcopy(data[i]))
-            data2.append(copy.deepcopy(data[i]))
-            data2.append(copy.deepcopy(data[i]))
-            data2[-5].data = t1
-            data2[-4].data = th
-            data2[-3].data = t2
-            data2[-2].data = ta
-            data2[-1].data = tdx
-            data2[-5].dataid += ' Standard Tilt Angle'
-            data2[-4].dataid += ' Hyperbolic Tilt Angle'
-            data2[-3].dataid += ' 2nd Order Tilt Angle'
-            data2[-2].dataid += ' Tilt Based Directional Derivative'
-            data2[-1].dataid += ' Total Derivative'
+        usejax = self.cb_jax.isChecked()
+        if usejax:
+            # JAX is slow to import, so it is only loaded when asked for.
+            # It can be found but still fail to import, for instance without
+            # jaxlib, in which case the numpy version is used.
+            from pygmi.raster import cooper_jax
+            usejax = cooper_jax.jax is not None
+        fast = self.cb_fast.isChecked() and not self.cb_jax.isChecked()
+
+        # Bands are independent, and the FFTs and most numpy work release
+        # the GIL, so several bands are done at once. The fast arctan is a
+        # parallel numba ufunc, which is not safe to launch from several
+        # threads with all numba threading layers.
+        nworkers = 1 if fast else min(len(data), os.cpu_count())
+
+        if usejax:
+            func = partial(cooper_jax.tilt1, azi=self.azi, s=self.smooth)
+        else:
+            # Bands done at once get one FFT thread each, so that the CPUs
+            # are not oversubscribed.
+            dtype = np.float32 if fast else np.float64
+            func = partial(tilt1, azi=self.azi, s=self.smooth, fast=fast,
+                           dtype=dtype, workers=1 if nworkers > 1 else -1)
+
+        # The pool threads plan their own FFTs, which is quick for sizes that
+        # have been planned before, since FFTW keeps its wisdom for the
+        # whole process.
+        with ThreadPoolExecutor(max_workers=max(nworkers, 1)) as ex:
+            # tilt1 fills masked values in place, so it gets a copy.
+            results = ex.map(func, [i.data.copy() for i in data])
+
+            for i in self.pbar.iter(range(len(data))):
+                t1, th, t2, ta, tdx = next(results)
+                data2.append(_copy_meta(data[i]))
+                data2.append(_copy_meta(data[i]))
+                data2.append(_copy_meta(data[i]))
+                data2.append(_copy_meta(data[i]))
+                data2.append(_copy_meta(data[i]))
+                data2[-5].data = t1
+                data2[-4].data = th
+                data2[-3].data = t2
+                data2[-2].data = ta
+                data2[-1].data = tdx
+                data2[-5].dataid += ' Standard Tilt Angle'
+                data2[-4].dataid += ' Hyperbolic Tilt Angle'
+                data2[-3].dataid += ' 2nd Order Tilt Angle'
+                data2[-2].dataid += ' Tilt Based Directional Derivative'
+                data2[-1].dataid += ' Total Derivative'
 
         for i in data2:
             i.data.data[i.data.mask] = i.nullvalue
@@ -642,7 +1083,7 @@ class Tilt1(QtWidgets.QDialog):
         return True
 
 
-def tilt1(data, azi, s):
+def tilt1(data, azi, s, fast=False, dtype=np.float64, workers=-1):
     """
     Tilt angle calculations.
 
@@ -654,6 +1095,23 @@ def tilt1(data, azi, s):
         directional filter azimuth in degrees from East
     s : int
         size of smoothing matrix to use - must be odd input 0 for no smoothing
+    fast : bool, optional
+        Use an approximate arctan for the standard tilt angle, tilt based
+        directional derivative and total derivative. This is meant for
+        display. The default is False.
+    dtype : numpy dtype, optional
+        Precision used after smoothing. np.float32 halves the memory traffic
+        of the derivatives, FFTs and tilt terms and is meant for previews.
+        The standard tilt angle, tilt based directional derivative and total
+        derivative are then within about 1e-4 radians of double precision,
+        the 2nd order tilt angle within about 1e-3, and the hyperbolic tilt
+        angle can be out by 0.1 radians where the ratio nears +-1, since
+        arctanh amplifies the single precision error of the vertical
+        derivative. np.float64 should be used for exports. The default is
+        np.float64.
+    workers : int, optional
+        Number of threads used by the FFTs. The default is -1, which uses
+        all CPUs.
 
     Returns
     -------
@@ -668,48 +1126,48 @@ def tilt1(data, azi, s):
     tdx : numpy masked array
         Total Derivative
     """
-    dmin = data.min()
-    dmax = data.max()
-    dm = 0.5*(dmin+dmax)
-    data.data[data.mask] = dm
-    data[np.isnan(data)] = dm
-    data[np.isinf(data)] = dm
-
-    if s > 0:
-        se = np.ones((s, s))/(s*s)
-        data2 = si.convolve2d(data, se, 'valid')  # smooth
-        mask = si.convolve2d(data.mask, se, 'valid')
-        data = np.ma.array(data2, mask=mask)
+    data, npts = _tilt_prep(data, s)
 
-    nr, nc = data.shape
+    data = data.astype(dtype, copy=False)
     dtr = np.pi/180.0
     azi = azi*dtr
 
-    dy, dx = np.gradient(data)
+    dy, dx = _grad2d(data)
 #    dx = dx.astype(np.float64)
 #    dy = dy.astype(np.float64)
     dxtot = np.ma.sqrt(dx*dx+dy*dy)
-    nmax = np.max([nr, nc])
-    npts = int(2**nextpow2(nmax))
-    dz = vertical(data, npts, 1)
-    t1 = np.ma.arctan(dz/dxtot)
+    dz = vertical(data, npts, 1, dtype, workers)
+    if fast:
+        # Masked cells keep the ratio, as np.ma.arctan does, since they are
+        # used in the 2nd order smoothing.
+        t1 = dz/dxtot
+        t1 = np.ma.array(np.where(np.ma.getmaskarray(t1), t1.data,
+                                  _fast_arctan2(t1.data, 1.)), mask=t1.mask)
+        tdx = _fast_arctan2(dxtot/abs(dz), 1.)
+    else:
+        t1 = np.ma.arctan(dz/dxtot)
+        tdx = np.real(np.ma.arctan(dxtot/abs(dz)))
     th = np.real(np.arctanh(np.nan_to_num(dz/dxtot)+(0+0j)))
-    tdx = np.real(np.ma.arctan(dxtot/abs(dz)))
 
-    dx1 = dx*np.cos(azi)+dy*np.sin(azi)  # Standard directional derivative
-    dx2 = dx*np.cos(azi+np.pi/2)+dy*np.sin(azi+np.pi/2)
+    sina = np.sin(azi).astype(dtype)
+    cosa = np.cos(azi).astype(dtype)
+    dx1 = dx*cosa+dy*sina  # Standard directional derivative
+    dx2 = dy*cosa-dx*sina
     dxz = np.ma.sqrt(dx2*dx2+dz*dz)
-    ta = np.ma.arctan(dx1/dxz)         # Tilt directional derivative
+    # Tilt directional derivative
+    if fast:
+        ta = _fast_arctan2(dx1/dxz, 1.)
+    else:
+        ta = np.ma.arctan(dx1/dxz)
 
     # 2nd order Tilt angle
 
     ts = t1
     if s < 3:
         s = 3
-    se = np.ones([s, s])/(s*s)
-    ts = si.convolve2d(t1, se, 'same')
-    [dxs, dys] = np.gradient(ts)
-    dzs = vertical(ts, npts, 1)
+    ts = ndimage.uniform_filter(np.asarray(t1), size=s, mode='constant')
+    dxs, dys = _grad2d(ts)
+    dzs = vertical(ts, npts, 1, dtype, workers)
     dxtots = np.ma.sqrt(dxs*dxs+dys*dys)
     t2 = np.ma.arctan(dzs/dxtots)
 
@@ -726,6 +1184,53 @@ def tilt1(data, azi, s):
     return t1, th, t2, ta, tdx
 
 
+def _tilt_prep(data, s):
+    """
+    Prepare data for the tilt angle calculations.
+
+    Masked, nan and inf values are filled with the middle of the data range,
+    in place, and the data is smoothed if required. This is shared by the
+    numpy and JAX versions of tilt1.
+
+    Parameters
+    ----------
+    data : numpy masked array
+        matrix of double to be filtered
+    s : int
+        size of smoothing matrix to use - must be odd input 0 for no smoothing
+
+    Returns
+    -------
+    data : numpy masked array
+        Filled and smoothed data.
+    npts : tuple
+        FFT grid size as (rows, columns).
+
+    """
+    dmin = data.min()
+    dmax = data.max()
+    dm = 0.5*(dmin+dmax)
+    data.data[data.mask] = dm
+    data[np.isnan(data)] = dm
+    data[np.isinf(data)] = dm
+
+    if s > 0:
+        # Box filter, trimmed to the 'valid' convolution shape.
+        nr, nc = data.shape
+        h = s//2
+        valid = np.s_[h:h+nr-s+1, h:h+nc-s+1]
+        # Integer rasters are smoothed in double precision.
+        data2 = ndimage.uniform_filter(data.data, size=s, output=np.float64,
+                                       mode='constant')
+        mask = ndimage.uniform_filter(np.ma.getmaskarray(data).astype(float),
+                                      size=s, mode='constant')
+        data = np.ma.array(data2[valid], mask=mask[valid] > 0.5/(s*s))
+
+    npts = _fft_shape(*data.shape)
+
+    return data, npts
+
+
 def nextpow2(n):
     """
     Next power of 2.
@@ -745,7 +1250,7 @@ def nextpow2(n):
     return m_i
 
 
-def vertical(data, npts=None, xint=1):
+def vertical(data, npts=None, xint=1, dtype=np.float64, workers=-1):
     """
     Vertical derivative.
 
@@ -753,10 +1258,19 @@ def vertical(data, npts=None, xint=1):
     ----------
     data : numpy array
         Input data.
-    npts : int, optional
-        Number of points. The default is None.
+    npts : int or tuple, optional
+        Padded size of the FFT grid, either a single value for a square grid
+        or (rows, columns). The default is None, which pads each axis by a
+        quarter of its length on either side, up to a fast FFT length.
     xint : float, optional
         X interval. The default is 1.
+    dtype : numpy dtype, optional
+        Precision of the FFTs. np.float32 gives errors of about 1e-6 of the
+        largest value, and is meant for previews. The default is
+        np.float64.
+    workers : int, optional
+        Number of threads used by the FFTs. The default is -1, which uses
+        all CPUs.
 
     Returns
     -------
@@ -766,34 +1280,120 @@ def vertical(data, npts=None, xint=1):
     """
     nr, nc = data.shape
 
-    z = data-np.ma.median(data)
-    if np.ma.is_masked(z):
-        z = z.filled(0.)
+    z = np.ma.filled(data-np.ma.median(data), 0.).astype(dtype, copy=False)
 
+    # Each axis is padded separately, so rectangular grids do not get
+    # transformed as large squares.
     if npts is None:
-        nmax = np.max([nr, nc])
-        npts = int(2**nextpow2(nmax))
-
-    cdiff = int(np.floor((npts-nc)/2))
-    rdiff = int(np.floor((npts-nr)/2))
-    cdiff2 = npts-cdiff-nc
-    rdiff2 = npts-rdiff-nr
+        npts = _fft_shape(nr, nc)
+    elif np.isscalar(npts):
+        npts = (int(npts), int(npts))
+    nptsr, nptsc = npts
+
+    cdiff = int(np.floor((nptsc-nc)/2))
+    rdiff = int(np.floor((nptsr-nr)/2))
+    cdiff2 = nptsc-cdiff-nc
+    rdiff2 = nptsr-rdiff-nr
     data1 = np.pad(z, [[rdiff, rdiff2], [cdiff, cdiff2]], 'edge')
 
-    f = np.fft.fft2(data1)
-    fz = f
-    wn = 2.0*np.pi/(xint*(npts-1))
-    f = np.fft.fftshift(f)
-    cx = npts/2+1
-    cy = cx
-    for i in range(npts):
-        freqx = (i+1-cx)*wn
-        for j in range(npts):
-            freqy = (j+1-cy)*wn
-            freq = np.sqrt(freqx*freqx+freqy*freqy)
-            fz[i, j] = f[i, j]*freq
-    fz = np.fft.fftshift(fz)
-    fzinv = np.fft.ifft2(fz)
-    dz = np.real(fzinv[rdiff:nr+rdiff, cdiff:nc+cdiff])
+    # The input is real, so only half the spectrum is needed. Wavenumbers
+    # are built directly in the unshifted FFT layout.
+    plans = _fft_plans(npts, data1.dtype, None if workers < 0 else workers)
+    if plans is None:
+        f = sfft.rfft2(data1, workers=workers)
+    else:
+        f = plans[0](data1)
+
+    freqx = sfft.fftfreq(nptsr)*nptsr*2.0*np.pi/(xint*(nptsr-1))
+    freqy = sfft.rfftfreq(nptsc)*nptsc*2.0*np.pi/(xint*(nptsc-1))
+    freq = np.sqrt(freqx[:, None]**2+freqy[None, :]**2).astype(dtype)
+
+    if plans is None:
+        fzinv = sfft.irfft2(f*freq, s=npts, workers=workers)
+    else:
+        fzinv = plans[1](f*freq)
+
+    # pyFFTW reuses its output array, so a copy is returned.
+    dz = fzinv[rdiff:nr+rdiff, cdiff:nc+cdiff].copy()
 
     return dz
+
+
+def _fft_shape(nr, nc):
+    """
+    Padded FFT grid size for a raster.
+
+    Each axis is padded by a quarter of its length on both sides to limit
+    edge effects, and rounded up to a fast real FFT length.
+
+    Parameters
+    ----------
+    nr : int
+        Number of rows.
+    nc : int
+        Number of columns.
+
+    Returns
+    -------
+    npts : tuple
+        Grid size as (rows, columns).
+
+    """
+    npts = (sfft.next_fast_len(nr+2*(nr//4), real=True),
+            sfft.next_fast_len(nc+2*(nc//4), real=True))
+
+    return npts
+
+
+def _fft_plans(npts, dtype, threads=None):
+    """
+    Get cached pyFFTW plans for real FFTs of a given grid size.
+
+    Plans are measured once per grid size and thread, and reused, since
+    tilt1 and other routines call vertical repeatedly on the same size grids.
+    Only the last _PLAN_CACHE_SIZE grid sizes are kept.
+
+    Parameters
+    ----------
+    npts : tuple
+        Grid size as (rows, columns).
+    dtype : numpy dtype
+        Real data type, np.float32 or np.float64.
+    threads : int, optional
+        Number of threads used by each FFT. The default is None, which uses
+        all CPUs.
+
+    Returns
+    -------
+    plans : tuple or None
+        Forward and inverse FFT plans, or None if pyFFTW is not installed.
+
+    """
+    if pyfftw is None:
+        return None
+
+    if not hasattr(_plan_cache, 'plans'):
+        _plan_cache.plans = OrderedDict()
+    plans = _plan_cache.plans
+
+    if threads is None:
+        threads = os.cpu_count()
+
+    dtype = np.dtype(dtype)
+    key = (npts, dtype, threads)
+    if key in plans:
+        plans.move_to_end(key)
+    else:
+        nptsr, nptsc = npts
+        ctype = np.result_type(dtype, np.complex64)
+        fwd = pyfftw.builders.rfft2(pyfftw.empty_aligned(npts, dtype=dtype),
+                                    threads=threads,
+                                    planner_effort='FFTW_MEASURE')
+        inv = pyfftw.builders.irfft2(
+            pyfftw.empty_aligned((nptsr, nptsc//2+1), dtype=ctype),
+            s=npts, threads=threads, planner_effort='FFTW_MEASURE')
+        plans[key] = (fwd, inv)
+        if len(plans) > _PLAN_CACHE_SIZE:
+            plans.popitem(last=False)
+
+    return plans[key]
@@ -0,0 +1,241 @@
+# -----------------------------------------------------------------------------
+# Name:        cooper_jax.py (part of PyGMI)
+#
+# Author:      Patrick Cole
+# E-Mail:      pcole@geoscience.org.za
+#
+# Copyright:   (c) 2013 Council for Geoscience
+# Licence:     GPL-3.0
+#
+# This file is part of PyGMI
+#
+# PyGMI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyGMI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# -----------------------------------------------------------------------------
+"""
+JAX versions of routines by Gordon Cooper.
+
+These mirror the numpy routines in pygmi.raster.cooper, and are compiled with
+XLA so they can run on a GPU or TPU if one is available. JAX is optional; if
+it cannot be imported, jax is None and the numpy routines should be used.
+Double precision is only enabled for the duration of each call, so other
+users of JAX in the same process are not affected.
+"""
+
+from functools import partial
+import numpy as np
+
+from pygmi.raster.cooper import _tilt_prep
+
+try:
+    import jax
+    import jax.numpy as jnp
+    import jax.scipy.signal as jsi
+    try:
+        from jax import enable_x64
+    except ImportError:
+        from jax.experimental import enable_x64
+except ImportError:
+    jax = None
+
+
+def tilt1(data, azi, s):
+    """
+    Tilt angle calculations, using JAX.
+
+    This gives the same results as pygmi.raster.cooper.tilt1. The masked
+    data handling is done with numpy, and the rest of the calculation is
+    compiled as a single XLA program.
+
+    Parameters
+    ----------
+    data : numpy array
+        matrix of double to be filtered
+    azi : float
+        directional filter azimuth in degrees from East
+    s : int
+        size of smoothing matrix to use - must be odd input 0 for no smoothing
+
+    Returns
+    -------
+    t1 : numpy masked array
+        Standard tilt angle
+    th : numpy masked array
+        Hyperbolic tilt angle
+    t2 : numpy masked array
+        2nd order tilt angle
+    ta : numpy masked array
+        Tilt Based Directional Derivative
+    tdx : numpy masked array
+        Total Derivative
+    """
+    if jax is None:
+        raise ImportError('JAX could not be imported.')
+
+    data, npts = _tilt_prep(data, s)
+
+    dtr = np.pi/180.0
+    azi = azi*dtr
+
+    mask = np.ma.getmaskarray(data)
+    z = np.ma.filled(data-np.ma.median(data), 0.)
+
+    # The numpy routines work in double precision.
+    with enable_x64(True):
+        out = _tilt_core(jnp.asarray(np.asarray(data.data, dtype=np.float64)),
+                         jnp.asarray(mask), jnp.asarray(z, dtype=np.float64),
+                         azi, max(s, 3), npts)
+        out = [np.array(i.block_until_ready()) for i in out]
+    t1, th, t2, ta, tdx, m1, mta, mtdx = out
+
+    # Standard tilt angle, hyperbolic tilt angle, 2nd order tilt angle,
+    # Tilt Based Directional Derivative, Total Derivative
+    t1 = np.ma.array(t1, mask=m1)
+    th = np.ma.array(th, mask=m1)
+    t2 = np.ma.array(t2, mask=m1)
+    ta = np.ma.array(ta, mask=mta)
+    tdx = np.ma.array(tdx, mask=mtdx)
+
+    return t1, th, t2, ta, tdx
+
+
+if jax is not None:
+    @partial(jax.jit, static_argnums=(4, 5))
+    def _tilt_core(data, mask, z, azi, s, npts):
+        """
+        Tilt angle kernel.
+
+        np.ma masks the result of a division wherever the denominator is
+        tiny compared to the numerator, and leaves the numerator in masked
+        cells. Both are reproduced here, since the masked values of t1 feed
+        the 2nd order smoothing.
+
+        Parameters
+        ----------
+        data : jax array
+            Data with masked values filled.
+        mask : jax array
+            Data mask.
+        z : jax array
+            Data less its median, with masked values set to zero.
+        azi : float
+            Azimuth in radians.
+        s : int
+            Size of 2nd order smoothing matrix.
+        npts : tuple
+            FFT grid size as (rows, columns).
+
+        Returns
+        -------
+        tuple
+            t1, th, t2, ta and tdx, followed by the masks for t1, ta and tdx.
+
+        """
+        tiny = np.finfo(np.float64).tiny
+
+        dy, dx = jnp.gradient(data)
+        gmask = _grad_mask(mask)
+        dxtot = jnp.sqrt(dx*dx+dy*dy)
+        dz = _vertical(z, npts)
+
+        m1 = gmask | (jnp.abs(dz)*tiny >= dxtot)
+        ratio = jnp.where(m1, dz, dz/jnp.where(m1, 1., dxtot))
+        t1 = jnp.where(m1, dz, jnp.arctan(ratio))
+
+        # np.ma sets arctanh to zero outside its domain.
+        dom = (ratio > 1.0-1e-15) | (ratio < -1.0+1e-15)
+        th = jnp.where(dom, 0., jnp.arctanh(jnp.where(dom, 0., ratio)))
+
+        adz = jnp.abs(dz)
+        mtdx = gmask | (dxtot*tiny >= adz)
+        tdx = jnp.arctan(dxtot/jnp.where(mtdx, 1., adz))
+
+        sina = jnp.sin(azi)
+        cosa = jnp.cos(azi)
+        dx1 = dx*cosa+dy*sina  # Standard directional derivative
+        dx2 = dy*cosa-dx*sina
+        dxz = jnp.sqrt(dx2*dx2+dz*dz)
+        mta = gmask | (jnp.abs(dx1)*tiny >= dxz)
+        ta = jnp.arctan(dx1/jnp.where(mta, 1., dxz))
+
+        # 2nd order Tilt angle
+        se = jnp.ones((s, s))/(s*s)
+        ts = jsi.convolve2d(t1, se, mode='same')
+        dxs, dys = jnp.gradient(ts)
+        dzs = _vertical(ts-jnp.median(ts), npts)
+        dxtots = jnp.sqrt(dxs*dxs+dys*dys)
+        t2 = jnp.arctan(dzs/dxtots)
+
+        return t1, th, t2, ta, tdx, m1, mta, mtdx
+
+
+def _grad_mask(mask):
+    """
+    Mask of a gradient of masked data.
+
+    A cell is masked if any of the cells used in its finite difference is
+    masked. Interior cells use their neighbours only.
+
+    Parameters
+    ----------
+    mask : jax array
+        Data mask.
+
+    Returns
+    -------
+    gmask : jax array
+        Gradient mask.
+
+    """
+    my = jnp.concatenate([mask[:1] | mask[1:2], mask[2:] | mask[:-2],
+                          mask[-2:-1] | mask[-1:]], axis=0)
+    mx = jnp.concatenate([mask[:, :1] | mask[:, 1:2],
+                          mask[:, 2:] | mask[:, :-2],
+                          mask[:, -2:-1] | mask[:, -1:]], axis=1)
+
+    return my | mx
+
+
+def _vertical(z, npts):
+    """
+    Vertical derivative.
+
+    Parameters
+    ----------
+    z : jax array
+        Input data, less its median and with no masked values.
+    npts : tuple
+        FFT grid size as (rows, columns).
+
+    Returns
+    -------
+    dz : jax array
+        Output data
+
+    """
+    nr, nc = z.shape
+    nptsr, nptsc = npts
+
+    cdiff = (nptsc-nc)//2
+    rdiff = (nptsr-nr)//2
+    data1 = jnp.pad(z, ((rdiff, nptsr-rdiff-nr), (cdiff, nptsc-cdiff-nc)),
+                    mode='edge')
+
+    freqx = np.fft.fftfreq(nptsr)*nptsr*2.0*np.pi/(nptsr-1)
+    freqy = np.fft.rfftfreq(nptsc)*nptsc*2.0*np.pi/(nptsc-1)
+    freq = np.sqrt(freqx[:, None]**2+freqy[None, :]**2)
+
+    fzinv = jnp.fft.irfft2(jnp.fft.rfft2(data1)*freq, s=npts)
+    dz = fzinv[rdiff:nr+rdiff, cdiff:nc+cdiff]
+
+    return dz
@@ -30,8 +30,10 @@ the tests.
 import sys
 from PyQt5 import QtWidgets
 import numpy as np
+from shapely import contains_xy
+from shapely.geometry import Polygon
 from pygmi.raster.datatypes import Data
-from pygmi.clust import cluster, crisp_clust, fuzzy_clust
+from pygmi.clust import cluster, crisp_clust, fuzzy_clust, super_class
 
 APP = QtWidgets.QApplication(sys.argv)  # Necessary to test Qt Classes
 
@@ -119,5 +121,96 @@ def test_fuzzy():
     np.testing.assert_array_equal(datout2, datout)
 
 
+def test_super_class(monkeypatch):
+    """test supervised classification."""
+    rows, cols = 20, 30
+    ymesh, xmesh = np.mgrid[:rows, :cols].astype(float)
+
+    # The bands are the pixel coordinates, so test pixels can be traced.
+    dat1 = Data()
+    dat1.data = np.ma.array(xmesh, mask=np.zeros([rows, cols], dtype=bool))
+    dat1.data.mask[0, 0] = True
+    dat1.dataid = 'x'
+
+    dat2 = Data()
+    dat2.data = np.ma.array(ymesh, mask=dat1.data.mask.copy())
+    dat2.dataid = 'y'
+
+    polys = [Polygon([(1.5, 1.5), (8.5, 1.5), (8.5, 8.5), (1.5, 8.5)]),
+             Polygon([(14.7, 9.2), (25.3, 9.2), (25.3, 17.6), (14.7, 17.6)])]
+
+    tmp = super_class.SuperClass(None)
+    tmp.indata = {'Raster': [dat1, dat2]}
+    tmp.map.data = tmp.indata['Raster']
+    tmp._classes = ['Class 1', 'Class 2']
+    tmp._geoms = polys
+
+    classifier, lbls, datall, X_test, y_test = tmp.init_classifier()
+
+    np.testing.assert_array_equal(lbls, [0, 1])
+    assert datall.shape == (rows, cols, 2)
+
+    # A quarter of the polygon pixels are kept for testing.
+    npix = [int(contains_xy(i, xmesh, ymesh).sum()) for i in polys]
+    assert X_test.shape == (np.ceil(0.25*sum(npix)), 2)
+    for lbl, poly in enumerate(polys):
+        xtmp = X_test[y_test == lbl]
+        assert contains_xy(poly, xtmp[:, 0], xtmp[:, 1]).all()
+
+    # The fitted classifier is reused until the training data changes.
+    assert tmp.init_classifier()[0] is classifier
+
+    monkeypatch.setattr(super_class.plt, 'show', lambda: None)
+    tmp.exec_ = lambda: 1
+    tmp.settings()
+
+    datout = tmp.outdata['Cluster'][0]
+    center = datout.metadata['Cluster']['center']
+    center_std = datout.metadata['Cluster']['center_std']
+    assert datout.data.mask[0, 0]
+
+    for i in range(2):
+        filt = datout.data.filled(0) == i+1
+        dat = np.transpose([dat1.data[filt], dat2.data[filt]])
+        np.testing.assert_allclose(center[i], dat.mean(0))
+        np.testing.assert_allclose(center_std[i], dat.std(0), atol=1e-9)
+
+
+def test_dist_points_to_segments():
+    """test point to segment distances."""
+    rng = np.random.default_rng(0)
+    pnt = np.array([0.3, -0.2])
+    s0 = rng.normal(size=(2*super_class.JIT_VERTS, 2))
+    s1 = rng.normal(size=(2*super_class.JIT_VERTS, 2))
+    s1[0] = s0[0]  # Zero length segment
+
+    dist2 = [super_class.dist_point_to_segment(pnt, i, j)
+             for i, j in zip(s0, s1)]
+
+    # Above JIT_VERTS segments the numba kernel is used.
+    dist = super_class.dist_points_to_segments(pnt, s0, s1)
+    np.testing.assert_allclose(dist, dist2, rtol=1e-12)
+
+    nverts = super_class.JIT_VERTS
+    dist = super_class.dist_points_to_segments(pnt, s0[:nverts], s1[:nverts])
+    np.testing.assert_allclose(dist, dist2[:nverts], rtol=1e-12)
+
+
+def test_scanline_fill():
+    """test scanline polygon fill."""
+    coords = [(1.3, 2.7), (30.6, 4.2), (25.1, 18.9), (14.4, 9.5),
+              (3.8, 21.2), (1.3, 2.7)]
+    poly = Polygon(coords)
+    vxy = np.array(coords)
+
+    datout2 = np.zeros((25, 35), dtype=np.int32)
+    super_class._scanline_fill(vxy[:, 0], vxy[:, 1], datout2, 2)
+
+    xmesh, ymesh = np.meshgrid(np.arange(35), np.arange(25))
+    datout = np.where(contains_xy(poly, xmesh, ymesh), 2, 0)
+
+    np.testing.assert_array_equal(datout2, datout)
+
+
 if __name__ == "__main__":
     test_fuzzy()
@@ -57,6 +57,19 @@ def test_dratio():
     np.testing.assert_array_equal(dat, dat2)
 
 
+def test_fast_arctan2():
+    """test fast approximate arctan2."""
+    rng = np.random.default_rng(0)
+    y = np.append(rng.normal(size=10000), [0., 0., 1., np.nan, np.nan])
+    x = np.append(rng.normal(size=10000), [0., -1., np.nan, 1., np.nan])
+    dat2 = np.arctan2(y, x)
+
+    for dtype in [np.float64, np.float32]:
+        dat = cooper._fast_arctan2(y.astype(dtype), x.astype(dtype))
+        assert dat.dtype == dtype
+        np.testing.assert_allclose(dat, dat2, rtol=0, atol=2.5e-6)
+
+
 def test_viz():
     """test vizibility."""
     datin = np.ma.array([[1, 2], [1, 2]])
@@ -72,6 +85,48 @@ def test_viz():
     np.testing.assert_array_equal(vsum, vsum2)
 
 
+def test_viz_window():
+    """test vizibility with a larger window and masked data."""
+    datin = np.ma.array([[(i*3+j*7) % 11 for j in range(8)]
+                         for i in range(8)], dtype=float)
+    datin.mask = np.zeros(datin.shape, dtype=bool)
+    datin.mask[4, 3] = True
+    mask2 = np.zeros((4, 4), dtype=bool)
+    mask2[2, 1] = True
+
+    vtot2 = [[19., 17., 17., 20.], [17., 20., 18., 16.],
+             [18., 16., 19., 16.], [19., 16., 20., 17.]]
+    vstd2 = [[0.7440238091428449, 0.6408699444616557, 0.8345229603962802,
+              0.5345224838248488],
+             [0.8345229603962802, 0.5345224838248488, 0.7071067811865476,
+              0.7559289460184544],
+             [0.7071067811865476, 0.7559289460184544, 0.5175491695067657,
+              0.7559289460184544],
+             [0.5175491695067657, 0.7559289460184544, 0.5345224838248488,
+              0.6408699444616557]]
+    vsum2 = [[3.557647291327849, 2.7979326519318137, 2.4842650573668283,
+              2.6131259297527536],
+             [2.4842650573668283, 2.6131259297527536, 3.2004125807650623,
+              1.5307337294603593],
+             [3.2004125807650623, 1.5307337294603593, 2.414213562373096,
+              2.613125929752753],
+             [2.414213562373096, 2.613125929752753, 2.6131259297527536,
+              2.7979326519318137]]
+    vtot, vstd, vsum = cooper.visibility2d(datin.copy(), 5, 0.5)
+
+    np.testing.assert_array_equal(vtot.data, vtot2)
+    np.testing.assert_allclose(vstd.data, vstd2)
+    np.testing.assert_allclose(vsum.data, vsum2)
+    np.testing.assert_array_equal(vtot.mask, mask2)
+
+    # Even windows look one point less far forward than backward.
+    vtot2 = [[11., 11., 10., 12.], [10., 12., 11., 10.],
+             [11., 10., 12., 10.], [12., 10., 12., 11.]]
+    vtot, vstd, vsum = cooper.visibility2d(datin.copy(), 4, 0.5)
+
+    np.testing.assert_array_equal(vtot.data, vtot2)
+
+
 def test_tilt1():
     """test tilt angle."""
     datin = np.ma.array([[1, 2], [1, 2]])
@@ -94,6 +149,70 @@ def test_tilt1():
     np.testing.assert_array_equal(tdx, tdx2)
 
 
+def test_tilt1_float32():
+    """test single precision tilt angle."""
+    rng = np.random.default_rng(1)
+    datin = np.ma.array(rng.normal(size=(97, 145)).cumsum(0).cumsum(1))
+
+    dat2 = cooper.tilt1(datin.copy(), 30, 3)
+    dat = cooper.tilt1(datin.copy(), 30, 3, dtype=np.float32)
+
+    # Standard, hyperbolic and 2nd order tilt, TDR and total derivative
+    for i, j, atol in zip(dat, dat2, [1e-3, 0.1, 1e-2, 1e-3, 1e-3]):
+        np.testing.assert_allclose(i, j, rtol=0, atol=atol)
+
+
+def test_tilt1_int():
+    """test smoothed tilt angle of integer data."""
+    rng = np.random.default_rng(0)
+    datin = np.ma.array(rng.integers(-3000, 3000, (40, 50)).cumsum(0),
+                        dtype=np.int16)
+
+    dat2 = cooper.tilt1(datin.astype(np.float64), 30, 3)
+    dat = cooper.tilt1(datin.copy(), 30, 3)
+
+    for i, j in zip(dat, dat2):
+        np.testing.assert_allclose(i, j, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize("s", [0, 5])
+def test_tilt1_jax(s):
+    """test JAX tilt angle against the numpy version."""
+    pytest.importorskip('jax')
+    from pygmi.raster import cooper_jax
+
+    rng = np.random.default_rng(0)
+    datin = np.ma.array(rng.normal(size=(40, 50)).cumsum(0))
+    datin.mask = np.zeros(datin.shape, dtype=bool)
+    datin.mask[10:15, 20:30] = True
+
+    dat2 = cooper.tilt1(datin.copy(), 30, s)
+    dat = cooper_jax.tilt1(datin.copy(), 30, s)
+
+    for i, j in zip(dat, dat2):
+        np.testing.assert_array_equal(np.ma.getmaskarray(i),
+                                      np.ma.getmaskarray(j))
+        np.testing.assert_allclose(i.filled(0.), j.filled(0.), rtol=0,
+                                   atol=1e-10)
+
+
+def test_vertical():
+    """test vertical derivative."""
+    rng = np.random.default_rng(0)
+    datin = np.ma.array(rng.normal(size=(40, 50)).cumsum(0))
+
+    dat2 = cooper.vertical(datin, 64)
+    dat = cooper.vertical(datin, (64, 64))
+    np.testing.assert_array_equal(dat, dat2)
+
+    dat2 = cooper.vertical(datin, (60, 75))
+    dat = cooper.vertical(datin, (60, 75), dtype=np.float32)
+    assert dat2.shape == datin.shape
+    assert dat.dtype == np.float32
+    np.testing.assert_allclose(dat, dat2, rtol=0,
+                               atol=1e-5*np.abs(dat2).max())
+
+
 def test_rtp():
     """test rtp."""
     datin = Data()